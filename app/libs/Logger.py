@@ -84,6 +84,24 @@ class Logger():
         )
         logger.info(message)
 
+    def warning(self, message: str) -> None:
+        """WARNINGログ出力
+
+        Args:
+            message (str): メッセージ
+        """
+        # 呼び出し元のファイル名
+        file_name = inspect.currentframe().f_back.f_code.co_filename
+        # 呼び出し元の行番号
+        line_no = inspect.currentframe().f_back.f_lineno
+
+        logger = self.__get_logger(
+            file_name=file_name,
+            line_no=line_no,
+            trace_shown=False
+        )
+        logger.warning(message)
+
     def error(self, message: str) -> None:
         """ERRORログ出力
 
@@ -0,0 +1,487 @@
+import cProfile
+import json
+import os
+import pstats
+import resource
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable
+from libs.Logger import Logger
+
+logger = Logger()
+
+
+class Profiler():
+    """Handlerのメソッド実行時のCPU・メモリ使用状況を計測する"""
+
+    PROFILES_PATH = "/app/storage/profiles"
+    APP_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    DEFAULT_REGRESSION_THRESHOLD = 1.2
+    # cProfileと同時に動かすため、既定では割り当て箇所の1フレームのみ記録する
+    DEFAULT_MEMORY_FRAMES = 1
+    # ベースラインとの比較対象とする指標
+    METRIC_KEYS = ("wall_time", "cpu_time", "traced_peak_bytes", "peak_rss_bytes")
+    # allocations.txtに出力する割り当て箇所の件数
+    TOP_ALLOCATIONS_LIMIT = 30
+    # 割り当て箇所ごとに出力する呼び出し経路の件数
+    TOP_PATHS_PER_ALLOCATION = 3
+    # メモリ使用量を確認する間隔(秒)
+    SAMPLE_INTERVAL = 0.05
+    # 実行中の計測結果をmetrics.jsonに書き出す間隔(秒)
+    LIVE_METRICS_INTERVAL = 1.0
+    # 前回のスナップショットからこれ以上増加した場合のみスナップショットを取得する(バイト)
+    PEAK_SNAPSHOT_STEP = 64 * 1024 * 1024
+    # 実行中に取得するスナップショットの上限
+    MAX_PEAK_SNAPSHOTS = 3
+    # 順位に関わらず比較対象とするパッケージ
+    WATCHED_PACKAGES = ("email", "json")
+    # ベースラインに保存する関数(自己時間の上位)の件数
+    TOP_FUNCTIONS_LIMIT = 50
+    # 自己時間の増加がこれより小さい関数は誤差とみなす(秒)
+    MIN_FUNCTION_DELTA = 0.001
+    # 悪化した関数のうち警告ログに出力する件数(自己時間の増加が大きい順)
+    MAX_FUNCTION_WARNINGS = 10
+    # cpu.collapsedに出力するスタックの上限と深さの上限
+    MAX_COLLAPSED_STACKS = 10000
+    MAX_COLLAPSED_DEPTH = 64
+
+    def __init__(self, command: str) -> None:
+        self.__command = command
+        self.__run_dir = os.path.join(
+            self.PROFILES_PATH,
+            command,
+            datetime.now().strftime("%Y%m%d_%H%M%S"),
+        )
+        self.__baseline_path = os.path.join(
+            self.PROFILES_PATH, f"baseline.{command}.json"
+        )
+
+    def run(self, func: Callable[[], Any]) -> Any:
+        """cProfileとtracemallocで計測しながら関数を実行し、計測結果を保存する
+
+        Args:
+            func (Callable[[], Any]): 計測対象の関数
+
+        Returns:
+            Any: 計測対象の関数の戻り値
+        """
+        memory_frames = max(1, self.__get_env_number(
+            "PROFILE_MEMORY_FRAMES", self.DEFAULT_MEMORY_FRAMES, int
+        ))
+
+        # OOM等で強制終了された場合にも実行中の計測結果を残せるよう先に作成する
+        try:
+            os.makedirs(self.__run_dir, exist_ok=True)
+        except Exception as e:
+            logger.error(f"Failed to create profile directory: {str(e)}")
+
+        # 計測用スレッドの生成による割り当てが計測結果に含まれないよう先に生成する
+        self.__finished = threading.Event()
+        sampler = threading.Thread(target=self.__sample, daemon=True)
+
+        profile = cProfile.Profile()
+        tracemalloc.start(memory_frames)
+        before_snapshot = tracemalloc.take_snapshot()
+
+        self.__peak_snapshot = None
+        self.__peak_snapshot_size, _ = tracemalloc.get_traced_memory()
+        self.__snapshot_count = 0
+        self.__overhead = {"wall_time": 0.0, "cpu_time": 0.0, "rss_bytes": 0}
+
+        succeeded = False
+        self.__started_at = time.perf_counter()
+        cpu_started_at = time.process_time()
+        sampler.start()
+
+        try:
+            profile.enable()
+            result = func()
+            succeeded = True
+            return result
+        finally:
+            profile.disable()
+            wall_time = time.perf_counter() - self.__started_at
+            cpu_time = time.process_time() - cpu_started_at
+            self.__finished.set()
+            sampler.join()
+
+            current, traced_peak = tracemalloc.get_traced_memory()
+            snapshot = self.__peak_snapshot
+            if snapshot is None or current >= self.__peak_snapshot_size:
+                snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+            # 計測結果の保存に失敗しても本来の処理結果には影響させない
+            try:
+                self.__save(profile, before_snapshot, snapshot, {
+                    "status": "succeeded" if succeeded else "failed",
+                    # 計測用スレッドの処理時間・メモリは除外する
+                    "wall_time": wall_time - self.__overhead["wall_time"],
+                    "cpu_time": cpu_time - self.__overhead["cpu_time"],
+                    "traced_peak_bytes": traced_peak,
+                    "peak_rss_bytes": self.__get_peak_rss()
+                    - self.__overhead["rss_bytes"],
+                    "profiler_overhead": self.__overhead,
+                    "memory_frames": memory_frames,
+                })
+            except Exception as e:
+                logger.error(f"Failed to save profile: {str(e)}")
+
+    def __sample(self) -> None:
+        """実行中のメモリ使用量を監視する(計測用スレッドで実行する)
+        一定間隔で実行中の計測結果をmetrics.jsonに書き出し、
+        メモリ使用量が大きく増加した場合のみスナップショットを取得する
+        """
+        last_written_at = 0.0
+
+        while not self.__finished.wait(self.SAMPLE_INTERVAL):
+            started_at = time.perf_counter()
+            current, traced_peak = tracemalloc.get_traced_memory()
+
+            if (
+                self.__snapshot_count < self.MAX_PEAK_SNAPSHOTS
+                and current >= self.__peak_snapshot_size + self.PEAK_SNAPSHOT_STEP
+            ):
+                rss_before = self.__get_peak_rss()
+                # 前回のスナップショットを先に解放してから取得する
+                self.__peak_snapshot = None
+                self.__peak_snapshot = tracemalloc.take_snapshot()
+                self.__peak_snapshot_size = current
+                self.__snapshot_count += 1
+                self.__overhead["rss_bytes"] += self.__get_peak_rss() - rss_before
+
+            if started_at - last_written_at >= self.LIVE_METRICS_INTERVAL:
+                last_written_at = started_at
+                try:
+                    self.__write_metrics({
+                        "status": "running",
+                        "elapsed": started_at - self.__started_at,
+                        "current_traced_bytes": current,
+                        "traced_peak_bytes": traced_peak,
+                        "rss_bytes": self.__get_current_rss(),
+                        "peak_rss_bytes": self.__get_peak_rss(),
+                    })
+                except Exception:
+                    pass
+
+            self.__overhead["wall_time"] += time.perf_counter() - started_at
+
+        self.__overhead["cpu_time"] = time.thread_time()
+
+    def __save(
+            self,
+            profile: cProfile.Profile,
+            before_snapshot: tracemalloc.Snapshot,
+            snapshot: tracemalloc.Snapshot,
+            metrics: dict,
+    ) -> None:
+        """計測結果をファイルに出力し、実行が成功していればベースラインと比較する
+
+        Args:
+            profile (cProfile.Profile): CPUプロファイル
+            before_snapshot (tracemalloc.Snapshot): 実行前のメモリ割り当てのスナップショット
+            snapshot (tracemalloc.Snapshot): ピーク付近のメモリ割り当てのスナップショット
+            metrics (dict): 実行結果と実行時間・メモリ使用量
+        """
+        stats = pstats.Stats(profile)
+        stats.dump_stats(os.path.join(self.__run_dir, "cpu.pstats"))
+
+        function_times = self.__get_function_times(stats)
+        metrics["functions"] = {
+            func: function_times[func]
+            for func in self.__select_functions(function_times)
+        }
+        self.__write_metrics(metrics)
+
+        summary = {key: metrics[key] for key in ("status",) + self.METRIC_KEYS}
+        logger.info(f"Profile saved to {self.__run_dir}: {summary}")
+
+        # 失敗した実行の計測結果はベースラインの保存・比較に使用しない
+        if metrics["status"] == "succeeded":
+            self.__compare_with_baseline(metrics, function_times)
+        else:
+            logger.info("Skipped baseline comparison because the command failed.")
+
+        self.__write_allocations(before_snapshot, snapshot)
+
+        with open(os.path.join(self.__run_dir, "cpu.collapsed"), "w") as file:
+            for stack, microseconds in self.__collapse_stacks(stats).items():
+                if microseconds > 0:
+                    file.write(f"{stack} {microseconds}\n")
+
+    def __write_metrics(self, metrics: dict) -> None:
+        """計測結果をmetrics.jsonに書き出す
+        書き込み中に強制終了されてもファイルが壊れないよう、一時ファイル経由で置き換える
+
+        Args:
+            metrics (dict): 計測結果
+        """
+        path = os.path.join(self.__run_dir, "metrics.json")
+        with open(f"{path}.tmp", "w") as file:
+            json.dump(metrics, file, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+    def __write_allocations(
+            self,
+            before_snapshot: tracemalloc.Snapshot,
+            snapshot: tracemalloc.Snapshot,
+    ) -> None:
+        """実行前からピーク時までに増加したメモリ割り当て箇所を出力する
+        PROFILE_MEMORY_FRAMESが2以上の場合は割り当て箇所ごとの呼び出し経路も出力する
+
+        Args:
+            before_snapshot (tracemalloc.Snapshot): 実行前のスナップショット
+            snapshot (tracemalloc.Snapshot): ピーク付近のスナップショット
+        """
+        filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+        before_snapshot = before_snapshot.filter_traces(filters)
+        snapshot = snapshot.filter_traces(filters)
+
+        top_stats = snapshot.compare_to(before_snapshot, "lineno")
+        path_stats = snapshot.compare_to(before_snapshot, "traceback") \
+            if snapshot.traceback_limit > 1 else []
+
+        with open(os.path.join(self.__run_dir, "allocations.txt"), "w") as file:
+            for stat in top_stats[:self.TOP_ALLOCATIONS_LIMIT]:
+                file.write(f"{stat}\n")
+
+                site = stat.traceback[0]
+                paths = [
+                    path_stat for path_stat in path_stats
+                    if path_stat.traceback[-1] == site
+                ][:self.TOP_PATHS_PER_ALLOCATION]
+                for path_stat in paths:
+                    file.write(f"  size={path_stat.size_diff:+} B\n")
+                    for line in path_stat.traceback.format(most_recent_first=True):
+                        file.write(f"    {line}\n")
+                file.write("\n")
+
+    def __get_function_times(self, stats: pstats.Stats) -> dict:
+        """Pythonで実装された関数の自己時間を取得する
+        組み込み関数はソケットの読み込みやsleep等の待ち時間を含み、
+        通信状況によってばらつくため対象外とする
+
+        Args:
+            stats (pstats.Stats): CPUプロファイルの統計情報
+
+        Returns:
+            dict: 関数名をキー、自己時間(秒)を値とする辞書
+        """
+        return {
+            pstats.func_std_string(func): self_time
+            for func, (_, _, self_time, _, _) in stats.stats.items()
+            if func[0] != "~"
+        }
+
+    def __select_functions(self, function_times: dict) -> list:
+        """ベースラインに保存する関数を選択する
+        自己時間の上位に加え、アプリケーション本体とWATCHED_PACKAGESの関数は
+        順位に関わらず選択する
+
+        Args:
+            function_times (dict): 関数名をキー、自己時間(秒)を値とする辞書
+
+        Returns:
+            list: 関数名のリスト
+        """
+        ranked = sorted(function_times, key=function_times.get, reverse=True)
+        selected = set(ranked[:self.TOP_FUNCTIONS_LIMIT])
+
+        for func in function_times:
+            file_name = func.rsplit(":", 1)[0]
+            if "site-packages" in file_name:
+                continue
+            if file_name.startswith(self.APP_PATH + os.sep) or any(
+                f"{os.sep}{package}{os.sep}" in file_name
+                for package in self.WATCHED_PACKAGES
+            ):
+                selected.add(func)
+
+        return sorted(selected)
+
+    def __get_env_number(self, name: str, default: Any, cast: type) -> Any:
+        """数値の環境変数を取得する
+        不正な値の場合はデフォルト値を使用する
+
+        Args:
+            name (str): 環境変数名
+            default (Any): デフォルト値
+            cast (type): 変換先の型
+
+        Returns:
+            Any: 環境変数の値
+        """
+        value = os.environ.get(name)
+        if value is None:
+            return default
+
+        try:
+            return cast(value)
+        except ValueError:
+            logger.warning(f"Invalid {name}: {value}. Using {default} instead.")
+            return default
+
+    def __get_peak_rss(self) -> int:
+        """プロセスのピークRSSを取得する
+
+        Returns:
+            int: ピークRSS(バイト)
+        """
+        # Linuxではru_maxrssの単位はKB
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def __get_current_rss(self) -> int:
+        """プロセスの現在のRSSを取得する
+
+        Returns:
+            int: 現在のRSS(バイト)。取得できない場合は0
+        """
+        try:
+            with open("/proc/self/statm", "r") as file:
+                return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            return 0
+
+    def __compare_with_baseline(self, metrics: dict, function_times: dict) -> None:
+        """ベースラインと計測結果を比較し、閾値を超えて悪化した指標と関数をログに出力する
+        ベースラインが存在しない場合、またはPROFILE_SAVE_BASELINEが"true"の場合は
+        今回の計測結果をベースラインとして保存する
+
+        Args:
+            metrics (dict): 今回の計測結果
+            function_times (dict): 今回の全関数の自己時間
+        """
+        if (
+            os.environ.get("PROFILE_SAVE_BASELINE") == "true"
+            or not os.path.exists(self.__baseline_path)
+        ):
+            with open(self.__baseline_path, "w") as file:
+                json.dump(metrics, file, indent=2)
+            logger.info(f"Profile baseline saved to {self.__baseline_path}")
+            return
+
+        with open(self.__baseline_path, "r") as file:
+            baseline = json.load(file)
+
+        threshold = self.__get_env_number(
+            "PROFILE_REGRESSION_THRESHOLD", self.DEFAULT_REGRESSION_THRESHOLD, float
+        )
+
+        for key in self.METRIC_KEYS:
+            base_value = baseline.get(key)
+            if not base_value:
+                continue
+
+            ratio = metrics[key] / base_value
+            if ratio > threshold:
+                logger.warning(
+                    f"Performance regression detected in {self.__command}: "
+                    f"{key} {base_value} -> {metrics[key]} ({ratio:.2f}x)"
+                )
+
+        regressions = []
+        for func, base_value in baseline.get("functions", {}).items():
+            # 今回呼び出されなかった関数は比較しない
+            value = function_times.get(func)
+            if value is None or value - base_value < self.MIN_FUNCTION_DELTA:
+                continue
+
+            ratio = value / base_value if base_value else float("inf")
+            if ratio > threshold:
+                regressions.append((func, base_value, value, ratio))
+
+        regressions.sort(key=lambda item: item[2] - item[1], reverse=True)
+        for func, base_value, value, ratio in regressions[:self.MAX_FUNCTION_WARNINGS]:
+            logger.warning(
+                f"Performance regression detected in {self.__command}: "
+                f"{func} self time {base_value:.4f}s -> "
+                f"{value:.4f}s ({ratio:.2f}x)"
+            )
+        if len(regressions) > self.MAX_FUNCTION_WARNINGS:
+            logger.warning(
+                f"{len(regressions) - self.MAX_FUNCTION_WARNINGS} more functions "
+                f"regressed in {self.__command}. See {self.__run_dir}/metrics.json."
+            )
+
+    def __collapse_stacks(self, stats: pstats.Stats) -> dict:
+        """cProfileの呼び出しグラフをフレームグラフ用のcollapsed stack形式に変換する
+        cProfileは完全なスタックを記録しないため、各呼び出し元からの累積時間の比率で
+        呼び出し先の自己時間を按分して近似する。サンプリングしたスタックではない点に注意
+        呼び出し経路の数は分岐に応じて増えるため、累積時間の大きい経路から順に探索し、
+        スタック数と深さに上限を設ける
+
+        Args:
+            stats (pstats.Stats): CPUプロファイルの統計情報
+
+        Returns:
+            dict: "呼び出し元;...;呼び出し先"をキー、自己時間(マイクロ秒)を値とする辞書
+        """
+        callees = {}
+        for func, (_, _, _, _, callers) in stats.stats.items():
+            for caller, (_, _, _, cumulative) in callers.items():
+                callees.setdefault(caller, []).append((func, cumulative))
+        for edges in callees.values():
+            edges.sort(key=lambda edge: edge[1], reverse=True)
+
+        collapsed = {}
+
+        def walk(func: tuple, path: list, weight: float) -> None:
+            if len(collapsed) >= self.MAX_COLLAPSED_STACKS:
+                return
+
+            _, _, self_time, _, _ = stats.stats[func]
+            stack = ";".join(self.__format_func(frame) for frame in path)
+            collapsed[stack] = collapsed.get(stack, 0) \
+                + int(self_time * weight * 1_000_000)
+
+            if len(path) >= self.MAX_COLLAPSED_DEPTH:
+                return
+
+            for callee, edge_cumulative in callees.get(func, []):
+                callee_cumulative = stats.stats[callee][3]
+                # 再帰呼び出しは展開しない
+                if callee in path or not callee_cumulative:
+                    continue
+
+                callee_weight = weight \
+                    * min(edge_cumulative / callee_cumulative, 1.0)
+                # 1マイクロ秒未満の枝は探索を打ち切る
+                if callee_cumulative * callee_weight < 0.000001:
+                    continue
+                walk(callee, path + [callee], callee_weight)
+
+        roots = sorted(
+            (
+                func for func, (_, _, _, _, callers) in stats.stats.items()
+                if not callers
+            ),
+            key=lambda func: stats.stats[func][3],
+            reverse=True,
+        )
+        for root in roots:
+            walk(root, [root], 1.0)
+
+        if len(collapsed) >= self.MAX_COLLAPSED_STACKS:
+            logger.info(
+                f"cpu.collapsed was truncated to {self.MAX_COLLAPSED_STACKS} stacks."
+            )
+
+        return collapsed
+
+    def __format_func(self, func: tuple) -> str:
+        """pstatsの関数キーをフレームグラフ表示用の文字列に変換する
+        同名のファイルの関数がまとめられないよう、ファイルパスは省略しない
+
+        Args:
+            func (tuple): (ファイル名, 行番号, 関数名)
+
+        Returns:
+            str: 表示用の関数名
+        """
+        file_name, line_no, func_name = func
+        return f"{func_name} ({file_name}:{line_no})"
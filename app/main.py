@@ -1,7 +1,9 @@
+import os
 import sys
 from dotenv import load_dotenv
 from Handler import Handler
 from libs.Logger import Logger
+from libs.Profiler import Profiler
 
 try:
     load_dotenv()
@@ -13,7 +15,11 @@ try:
     logger.info("Process started.")
 
     try:
-        getattr(handler, command)()
+        method = getattr(handler, command)
+        if os.environ.get("PROFILE_ENABLED") == "true":
+            Profiler(command).run(method)
+        else:
+            method()
     except AttributeError as e:
         logger.error(f"Failed to execute Handler method: {str(e)}")
         exit()